@@ -7,10 +7,107 @@
 from __future__ import annotations
 import logging
 import asyncio
-from typing import TYPE_CHECKING, Dict, Any
+import functools
+from ..common import RequestType
+from typing import TYPE_CHECKING, Dict, Any, Tuple, List, Callable, Coroutine
 if TYPE_CHECKING:
     from ..confighelper import ConfigHelper
+    from ..common import WebRequest
     from .klippy_apis import KlippyAPI as APIComp
+    HandlerType = Callable[
+        ["CNCMCodesHandler", WebRequest], Coroutine[Any, Any, Dict[str, Any]]
+    ]
+
+# Maximum age (in seconds) of a cached Klippy status query
+STATUS_CACHE_TTL = .25
+# Time (in seconds) to wait for additional gcode requests before
+# sending a batch to Klippy, and the maximum number of requests per batch
+GCODE_BATCH_DELAY = .005
+GCODE_BATCH_SIZE = 16
+# Commands that may share a batch.  Each one only sets an output state,
+# never blocks or pauses Klippy, and can safely be sent again if a batch
+# fails.  "S" covers spindle speed words.
+BATCHABLE_GCODES = frozenset([
+    "S", "M3", "M4", "M5", "M7", "M8", "M9",
+    "M62", "M63", "M64", "M65", "M67", "M68"
+])
+# Status query arguments shared by all requests.  These must not be
+# modified.
+CNC_STATUS_QUERY: Dict[str, None] = {'cnc_m_codes': None}
+CNC_EXT_QUERY: Dict[str, None] = {'cnc_extended_m_codes': None}
+STATUS_QUERIES: Dict[str, Dict[str, None]] = {
+    'cnc_m_codes': CNC_STATUS_QUERY,
+    'cnc_extended_m_codes': CNC_EXT_QUERY
+}
+# Responses that never vary are shared between requests.  These must not
+# be modified.
+KLIPPY_DISCONNECTED_RESP: Dict[str, Any] = {
+    'result': 'error',
+    'message': 'Klippy not connected'
+}
+MODAL_TRACKING_RESP: Dict[str, Any] = {
+    'result': 'success',
+    'message': 'Modal state tracking active'
+}
+MODAL_CLEARED_RESP: Dict[str, Any] = {
+    'result': 'success',
+    'message': 'All modal states cleared'
+}
+DIO_STATUS_RESP: Dict[str, Any] = {
+    'result': 'success',
+    'message': 'Digital I/O status retrieved'
+}
+AIO_STATUS_RESP: Dict[str, Any] = {
+    'result': 'success',
+    'message': 'Analog I/O status retrieved'
+}
+SUBROUTINE_RETURN_RESP: Dict[str, Any] = {
+    'result': 'success',
+    'command': 'M99',
+    'action': 'return',
+    'message': 'Returned from subroutine'
+}
+# Maximum nesting depth of saved modal states
+MAX_MODAL_STATES = 10
+# Registered endpoints: (path, request types, callback name, description)
+CNC_ENDPOINTS: Tuple[Tuple[str, Tuple[str, ...], str, str], ...] = (
+    ("/server/cnc/tool_change", ("POST",), "_handle_tool_change",
+     "Tool change"),
+    ("/server/cnc/status", ("GET",), "_handle_cnc_status", "CNC status"),
+    ("/server/cnc/coolant", ("GET", "POST"), "_handle_coolant", "Coolant"),
+    ("/server/cnc/spindle", ("GET", "POST"), "_handle_spindle", "Spindle"),
+    ("/server/cnc/modal_state", ("GET", "POST", "DELETE"),
+     "_handle_modal_state", "Modal state"),
+    ("/server/cnc/pallet_change", ("POST",), "_handle_pallet_change",
+     "Pallet change"),
+    ("/server/cnc/digital_io", ("GET", "POST"), "_handle_digital_io",
+     "Digital I/O"),
+    ("/server/cnc/analog_io", ("GET", "POST"), "_handle_analog_io",
+     "Analog I/O"),
+    ("/server/cnc/subroutine", ("POST",), "_handle_subroutine", "Subroutine")
+)
+ENDPOINT_SUMMARY = tuple(
+    f"  - {desc}: {'/'.join(req_types)} {path}"
+    for path, req_types, _, desc in CNC_ENDPOINTS
+)
+
+def _gcode_word(line: str) -> str:
+    """Return the command word of a gcode line, ie: "M3" or "S" """
+    word = line.strip().split(" ", 1)[0].upper()
+    if word[:1] == "S" and word[1:].replace(".", "", 1).isdigit():
+        return "S"
+    return word
+
+def _require_klippy(func: HandlerType) -> HandlerType:
+    """Reject requests received before Klippy is ready"""
+    @functools.wraps(func)
+    async def wrapper(
+        self: CNCMCodesHandler, web_request: WebRequest
+    ) -> Dict[str, Any]:
+        if self.klippy_apis is None:
+            return KLIPPY_DISCONNECTED_RESP
+        return await func(self, web_request)
+    return wrapper
 
 class CNCMCodesHandler:
     """
@@ -24,86 +121,202 @@ class CNCMCodesHandler:
     - Modal state backup/restore
     """
     
+    # Digital output commands keyed by (synchronized, value).  M62/M63
+    # are synchronized with motion, M64/M65 are immediate.
+    _DIO_CMDS: Dict[Tuple[bool, bool], str] = {
+        (True, True): "M62 P%d",
+        (True, False): "M63 P%d",
+        (False, True): "M64 P%d",
+        (False, False): "M65 P%d"
+    }
+    # Coolant scripts keyed by the requested (mist, flood) state, where
+    # None leaves that coolant unchanged.  M9 turns off all coolant, so it
+    # must precede any M7/M8 in the same script.
+    _COOLANT_CMDS: Dict[Tuple[bool | None, bool | None], str] = {
+        (True, None): "M7",
+        (False, None): "M9",
+        (None, True): "M8",
+        (None, False): "M9",
+        (True, True): "M7\nM8",
+        (True, False): "M9\nM7",
+        (False, True): "M9\nM8",
+        (False, False): "M9"
+    }
+    # Modal state commands keyed by action
+    _MODAL_CMDS: Dict[str, str] = {
+        'save': 'M70',
+        'restore': 'M72',
+        'invalidate': 'M71',
+        'auto_save': 'M73'
+    }
+    # Operator prompt displayed during a manual tool change
+    _M117_INSERT_TPL = "M117 Insert Tool T%d and resume"
+    # Spindle (direction, command) keyed by the requested direction.  The
+    # common casings are listed so they don't need to be lowercased.
+    _SPINDLE_DIRS: Dict[str, Tuple[str, str]] = {
+        'cw': ('cw', 'M3'),
+        'CW': ('cw', 'M3'),
+        'Cw': ('cw', 'M3'),
+        'cW': ('cw', 'M3'),
+        'ccw': ('ccw', 'M4'),
+        'CCW': ('ccw', 'M4')
+    }
+    
     def __init__(self, config: ConfigHelper) -> None:
         self.server = config.get_server()
+        self.eventloop = self.server.get_event_loop()
         self.klippy_apis: APIComp | None = None
+        self._status_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._refresh_locks: Dict[str, asyncio.Lock] = {}
+        self._status_generation: int = 0
+        self._gcode_queue: asyncio.Queue[Tuple[str, asyncio.Future, bool]]
+        self._gcode_queue = asyncio.Queue()
+        self._batch_task: asyncio.Task | None = None
         
         # Register REST API endpoints
-        self.server.register_endpoint(
-            "/server/cnc/tool_change",
-            request_types=['POST'],
-            callback=self._handle_tool_change
-        )
-        
-        self.server.register_endpoint(
-            "/server/cnc/status",
-            request_types=['GET'],
-            callback=self._handle_cnc_status
-        )
-        
-        self.server.register_endpoint(
-            "/server/cnc/coolant",
-            request_types=['GET', 'POST'],
-            callback=self._handle_coolant
-        )
-        
-        self.server.register_endpoint(
-            "/server/cnc/spindle",
-            request_types=['GET', 'POST'],
-            callback=self._handle_spindle
-        )
-        
-        self.server.register_endpoint(
-            "/server/cnc/modal_state",
-            request_types=['GET', 'POST', 'DELETE'],
-            callback=self._handle_modal_state
-        )
-        
-        self.server.register_endpoint(
-            "/server/cnc/pallet_change",
-            request_types=['POST'],
-            callback=self._handle_pallet_change
-        )
-        
-        self.server.register_endpoint(
-            "/server/cnc/digital_io",
-            request_types=['GET', 'POST'],
-            callback=self._handle_digital_io
-        )
-        
-        self.server.register_endpoint(
-            "/server/cnc/analog_io",
-            request_types=['GET', 'POST'],
-            callback=self._handle_analog_io
-        )
-        
-        self.server.register_endpoint(
-            "/server/cnc/subroutine",
-            request_types=['POST'],
-            callback=self._handle_subroutine
-        )
+        for path, req_types, callback, _ in CNC_ENDPOINTS:
+            self.server.register_endpoint(
+                path,
+                request_types=list(req_types),
+                callback=getattr(self, callback)
+            )
         
         # Wait for Klippy to be ready
         self.server.register_event_handler(
             "server:klippy_ready", self._handle_klippy_ready
         )
         
-        logging.info("CNC M-Codes Handler initialized")
-        logging.info("  - Tool change: POST /server/cnc/tool_change")
-        logging.info("  - CNC status: GET /server/cnc/status")
-        logging.info("  - Coolant: GET/POST /server/cnc/coolant")
-        logging.info("  - Spindle: GET/POST /server/cnc/spindle")
-        logging.info("  - Modal state: GET/POST/DELETE /server/cnc/modal_state")
-        logging.info("  - Pallet change: POST /server/cnc/pallet_change")
-        logging.info("  - Digital I/O: GET/POST /server/cnc/digital_io")
-        logging.info("  - Analog I/O: GET/POST /server/cnc/analog_io")
-        logging.info("  - Subroutine: POST /server/cnc/subroutine")
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info(
+                "CNC M-Codes Handler initialized:\n" +
+                "\n".join(ENDPOINT_SUMMARY)
+            )
     
     async def _handle_klippy_ready(self) -> None:
         """Initialize Klippy APIs when ready"""
         self.klippy_apis = self.server.lookup_component('klippy_apis')
+        if self._batch_task is None or self._batch_task.done():
+            self._batch_task = self.eventloop.create_task(
+                self._gcode_batcher()
+            )
         logging.info("CNC M-Codes Handler: Connected to Klippy")
     
+    def _submit_gcode(self, script: str) -> asyncio.Future:
+        """Queue a gcode script for the next batch sent to Klippy"""
+        fut = self.eventloop.create_future()
+        batchable = all(
+            _gcode_word(line) in BATCHABLE_GCODES
+            for line in script.split("\n")
+        )
+        self._gcode_queue.put_nowait((script, fut, batchable))
+        return fut
+    
+    async def _gcode_batcher(self) -> None:
+        """
+        Collect gcode requests received in quick succession and send
+        them to Klippy as a single script.  Scripts that are not made up
+        entirely of BATCHABLE_GCODES are always sent on their own.
+        """
+        queue = self._gcode_queue
+        pending: Tuple[str, asyncio.Future, bool] | None = None
+        while True:
+            if pending is None:
+                pending = await queue.get()
+            batch = [pending]
+            pending = None
+            try:
+                if batch[0][2]:
+                    await asyncio.sleep(GCODE_BATCH_DELAY)
+                    while (
+                        len(batch) < GCODE_BATCH_SIZE and not queue.empty()
+                    ):
+                        item = queue.get_nowait()
+                        if not item[2]:
+                            # Send it on its own once this batch completes
+                            pending = item
+                            break
+                        batch.append(item)
+                await self._send_gcode_batch(batch)
+            except asyncio.CancelledError:
+                for _, fut, _ in batch:
+                    fut.cancel()
+                if pending is not None:
+                    pending[1].cancel()
+                raise
+            finally:
+                # Commands may have changed the reported status, including
+                # those that ran before a failure.  Invalidate the cache and
+                # discard the results of queries still in flight.
+                self._status_generation += 1
+                self._status_cache.clear()
+    
+    async def _send_gcode_batch(
+        self, batch: List[Tuple[str, asyncio.Future, bool]]
+    ) -> None:
+        assert self.klippy_apis is not None
+        if len(batch) > 1:
+            script = "\n".join([cmd for cmd, _, _ in batch])
+            try:
+                result = await self.klippy_apis.run_gcode(script)
+            except Exception as e:
+                # Klippy stops at the failing command and there is no way
+                # to tell which request it belonged to.  Send each request
+                # on its own so every caller gets its own result.
+                logging.debug(
+                    f"Batched gcode failed, resending individually: {e}"
+                )
+            else:
+                for _, fut, _ in batch:
+                    if not fut.done():
+                        fut.set_result(result)
+                return
+        for script, fut, _ in batch:
+            try:
+                result = await self.klippy_apis.run_gcode(script)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(result)
+    
+    def _get_cached_status(self, obj: str) -> Dict[str, Any] | None:
+        cached = self._status_cache.get(obj)
+        if cached is None:
+            return None
+        timestamp, status = cached
+        if self.eventloop.get_loop_time() - timestamp >= STATUS_CACHE_TTL:
+            return None
+        return status
+    
+    async def _get_cnc_status(self, obj: str = 'cnc_m_codes') -> Dict[str, Any]:
+        """
+        Query the status of a Klippy object, sharing the result between
+        all requests received within STATUS_CACHE_TTL
+        """
+        status = self._get_cached_status(obj)
+        if status is not None:
+            return status
+        lock = self._refresh_locks.get(obj)
+        if lock is None:
+            lock = self._refresh_locks[obj] = asyncio.Lock()
+        async with lock:
+            # The cache may have been refreshed while waiting on the lock
+            status = self._get_cached_status(obj)
+            if status is not None:
+                return status
+            assert self.klippy_apis is not None
+            generation = self._status_generation
+            result = await self.klippy_apis.query_objects(STATUS_QUERIES[obj])
+            status = result.get(obj, {})
+            # Don't cache status that may predate a command sent to Klippy
+            if generation == self._status_generation:
+                self._status_cache[obj] = (
+                    self.eventloop.get_loop_time(), status
+                )
+            return status
+    
+    @_require_klippy
     async def _handle_tool_change(self, web_request) -> Dict[str, Any]:
         """
         Handle M6 Tool Change
@@ -121,71 +334,89 @@ class CNCMCodesHandler:
         
         logging.info(f"CNC Tool Change: T{tool} (manual={manual}, pause={pause})")
         
-        if not self.klippy_apis:
-            return {
-                'result': 'error',
-                'message': 'Klippy not connected'
-            }
-        
         try:
-            # Build G-Code command sequence for tool change
-            commands = []
-            
-            if pause:
-                commands.append("M0")  # Pause for tool change
-            
-            commands.append(f"T{tool}")  # Select tool
-            
+            # Build G-Code command sequence for tool change.  M0 pauses
+            # for the tool change, T selects the tool.
+            select = f"T{tool}"
             if manual:
-                commands.append("M117 Insert Tool T{tool} and resume")
+                prompt = self._M117_INSERT_TPL % tool
+                commands: Tuple[str, ...] = (
+                    ("M0", select, prompt) if pause else (select, prompt)
+                )
+            else:
+                commands = ("M0", select) if pause else (select,)
             
-            # Execute commands
-            result = await self.klippy_apis.run_gcode("\n".join(commands))
+            # Execute commands, querying the CNC status concurrently.  The
+            # status may be served from the cache, so it reflects the state
+            # before the tool change and may be up to STATUS_CACHE_TTL old.
+            gc_result, status_result = await asyncio.gather(
+                self._submit_gcode(
+                    commands[0] if len(commands) == 1
+                    else "\n".join(commands)
+                ),
+                self._get_cnc_status(),
+                return_exceptions=True
+            )
+            if isinstance(gc_result, BaseException):
+                raise gc_result
+            status: Dict[str, Any] | None = None
+            if isinstance(status_result, BaseException):
+                # The tool change was issued, don't report it as failed
+                logging.debug(
+                    f"Tool change status query failed: {status_result}"
+                )
+            else:
+                status = status_result
             
             return {
                 'result': 'success',
                 'tool': tool,
                 'manual': manual,
-                'commands': commands
+                'commands': commands,
+                'status': status
+            }
+        except self.server.error as e:
+            logging.debug(f"Tool change rejected: {e}")
+            return {
+                'result': 'error',
+                'message': str(e)
             }
         except Exception as e:
-            logging.exception(f"Tool change failed: {e}")
+            logging.exception("Tool change failed")
             return {
                 'result': 'error',
                 'message': str(e)
             }
     
+    @_require_klippy
     async def _handle_cnc_status(self, web_request) -> Dict[str, Any]:
         """
         Get comprehensive CNC status
         
         GET /server/cnc/status
         """
-        if not self.klippy_apis:
-            return {
-                'result': 'error',
-                'message': 'Klippy not connected'
-            }
-        
         try:
             # Query CNC M-Codes module status
-            result = await self.klippy_apis.query_objects(
-                {'cnc_m_codes': None}
-            )
-            
-            status = result.get('cnc_m_codes', {})
+            status = await self._get_cnc_status()
             
             return {
                 'result': 'success',
                 'status': status
             }
+        except self.server.error as e:
+            logging.debug(f"Status query rejected: {e}")
+            return {
+                'result': 'error',
+                'message': str(e)
+            }
         except Exception as e:
-            logging.exception(f"Status query failed: {e}")
+            logging.exception("Status query failed")
             return {
                 'result': 'error',
                 'message': str(e)
             }
     
+    @_require_klippy
     async def _handle_coolant(self, web_request) -> Dict[str, Any]:
         """
         Control coolant
@@ -197,16 +428,10 @@ class CNCMCodesHandler:
             "flood": true/false
         }
         """
-        if web_request.get_request_type() == 'GET':
+        if web_request.get_request_type() == RequestType.GET:
             # Get status
-            if not self.klippy_apis:
-                return {'result': 'error', 'message': 'Klippy not connected'}
-            
             try:
-                result = await self.klippy_apis.query_objects(
-                    {'cnc_m_codes': None}
-                )
-                status = result.get('cnc_m_codes', {})
+                status = await self._get_cnc_status()
                 
                 return {
                     'result': 'success',
@@ -220,17 +445,18 @@ class CNCMCodesHandler:
             mist = web_request.get_boolean('mist', None)
             flood = web_request.get_boolean('flood', None)
             
-            if not self.klippy_apis:
-                return {'result': 'error', 'message': 'Klippy not connected'}
-            
-            commands = []
-            if mist is not None:
-                commands.append("M7" if mist else "M9")
-            if flood is not None:
-                commands.append("M8" if flood else "M9")
+            if mist is None and flood is None:
+                # Nothing requested, don't send an empty script to Klippy
+                return {
+                    'result': 'success',
+                    'mist': mist,
+                    'flood': flood,
+                    'message': 'no-op'
+                }
+            command = self._COOLANT_CMDS[(mist, flood)]
             
             try:
-                await self.klippy_apis.run_gcode("\n".join(commands))
+                await self._submit_gcode(command)
                 return {
                     'result': 'success',
                     'mist': mist,
@@ -239,6 +465,7 @@ class CNCMCodesHandler:
             except Exception as e:
                 return {'result': 'error', 'message': str(e)}
     
+    @_require_klippy
     async def _handle_spindle(self, web_request) -> Dict[str, Any]:
         """
         Control spindle
@@ -251,16 +478,10 @@ class CNCMCodesHandler:
             "speed": 1000  // Optional RPM
         }
         """
-        if web_request.get_request_type() == 'GET':
+        if web_request.get_request_type() == RequestType.GET:
             # Get status
-            if not self.klippy_apis:
-                return {'result': 'error', 'message': 'Klippy not connected'}
-            
             try:
-                result = await self.klippy_apis.query_objects(
-                    {'cnc_m_codes': None}
-                )
-                status = result.get('cnc_m_codes', {})
+                status = await self._get_cnc_status()
                 
                 return {
                     'result': 'success',
@@ -273,29 +494,28 @@ class CNCMCodesHandler:
         
         else:  # POST
             enable = web_request.get_boolean('enable')
-            direction = web_request.get('direction', 'cw').lower()
+            direction = web_request.get_str('direction', 'cw')
             speed = web_request.get_int('speed', 0)
             
-            if not self.klippy_apis:
-                return {'result': 'error', 'message': 'Klippy not connected'}
-            
-            commands = []
-            
             if enable:
-                if speed > 0:
-                    commands.append(f"S{speed}")
-                
-                if direction == 'cw':
-                    commands.append("M3")
-                elif direction == 'ccw':
-                    commands.append("M4")
-                else:
+                spindle_dir = (
+                    self._SPINDLE_DIRS.get(direction) or
+                    self._SPINDLE_DIRS.get(direction.lower())
+                )
+                if spindle_dir is None:
                     return {'result': 'error', 'message': 'Invalid direction'}
+                direction, command = spindle_dir
+                commands: Tuple[str, ...] = (
+                    (f"S{speed}", command) if speed > 0 else (command,)
+                )
             else:
-                commands.append("M5")
+                commands = ("M5",)
             
             try:
-                await self.klippy_apis.run_gcode("\n".join(commands))
+                await self._submit_gcode(
+                    commands[0] if len(commands) == 1
+                    else "\n".join(commands)
+                )
                 return {
                     'result': 'success',
                     'enable': enable,
@@ -305,6 +525,7 @@ class CNCMCodesHandler:
             except Exception as e:
                 return {'result': 'error', 'message': str(e)}
     
+    @_require_klippy
     async def _handle_modal_state(self, web_request) -> Dict[str, Any]:
         """
         Manage modal state
@@ -316,35 +537,21 @@ class CNCMCodesHandler:
         }
         DELETE /server/cnc/modal_state - Clear all saved states
         """
-        if not self.klippy_apis:
-            return {'result': 'error', 'message': 'Klippy not connected'}
-        
         request_type = web_request.get_request_type()
         
-        if request_type == 'GET':
+        if request_type == RequestType.GET:
             try:
-                result = await self.klippy_apis.query_objects(
-                    {'cnc_m_codes': None}
-                )
-                # Would need to add state_count to get_status in Klipper module
-                return {
-                    'result': 'success',
-                    'message': 'Modal state tracking active'
-                }
+                # The status only confirms the module is available.  Would
+                # need to add state_count to get_status in Klipper module
+                await self._get_cnc_status()
+                return MODAL_TRACKING_RESP
             except Exception as e:
                 return {'result': 'error', 'message': str(e)}
         
-        elif request_type == 'POST':
+        elif request_type == RequestType.POST:
             action = web_request.get('action', 'save')
             
-            command_map = {
-                'save': 'M70',
-                'restore': 'M72',
-                'invalidate': 'M71',
-                'auto_save': 'M73'
-            }
-            
-            command = command_map.get(action)
+            command = self._MODAL_CMDS.get(action)
             if not command:
                 return {
                     'result': 'error',
@@ -352,7 +559,7 @@ class CNCMCodesHandler:
                 }
             
             try:
-                await self.klippy_apis.run_gcode(command)
+                await self._submit_gcode(command)
                 return {
                     'result': 'success',
                     'action': action,
@@ -361,25 +568,29 @@ class CNCMCodesHandler:
             except Exception as e:
                 return {'result': 'error', 'message': str(e)}
         
-        elif request_type == 'DELETE':
-            # Clear all saved states by sending M71 repeatedly
+        elif request_type == RequestType.DELETE:
+            # Clear all saved states by sending M71 for each possible
+            # nesting level.  M71 is a no-op once the stack is empty, so
+            # the entire sequence is sent as a single script.
             try:
-                # Send M71 multiple times to clear stack
-                for _ in range(10):  # Max 10 nested states
+                await self._submit_gcode(
+                    "\n".join(["M71"] * MAX_MODAL_STATES)
+                )
+            except Exception as e:
+                logging.debug(
+                    f"Batched modal state clear failed: {e}, "
+                    "retrying one state at a time"
+                )
+                for _ in range(MAX_MODAL_STATES):
                     try:
-                        await self.klippy_apis.run_gcode("M71")
-                    except:
+                        await self._submit_gcode("M71")
+                    except Exception:
                         break  # No more states to clear
-                
-                return {
-                    'result': 'success',
-                    'message': 'All modal states cleared'
-                }
-            except Exception as e:
-                return {'result': 'error', 'message': str(e)}
+            return MODAL_CLEARED_RESP
         
         return {'result': 'error', 'message': 'Invalid request type'}
     
+    @_require_klippy
     async def _handle_pallet_change(self, web_request) -> Dict[str, Any]:
         """
         Handle M60 Pallet Change
@@ -393,15 +604,9 @@ class CNCMCodesHandler:
         
         logging.info(f"CNC Pallet Change: M60 (pause={pause})")
         
-        if not self.klippy_apis:
-            return {
-                'result': 'error',
-                'message': 'Klippy not connected'
-            }
-        
         try:
             # Execute M60 command
-            await self.klippy_apis.run_gcode("M60")
+            await self._submit_gcode("M60")
             
             return {
                 'result': 'success',
@@ -409,13 +614,20 @@ class CNCMCodesHandler:
                 'pause': pause,
                 'message': 'Pallet change initiated - Exchange pallet and resume'
             }
+        except self.server.error as e:
+            logging.debug(f"Pallet change rejected: {e}")
+            return {
+                'result': 'error',
+                'message': str(e)
+            }
         except Exception as e:
-            logging.exception(f"Pallet change failed: {e}")
+            logging.exception("Pallet change failed")
             return {
                 'result': 'error',
                 'message': str(e)
             }
     
+    @_require_klippy
     async def _handle_digital_io(self, web_request) -> Dict[str, Any]:
         """
         Control Digital I/O (M62-M66)
@@ -437,22 +649,13 @@ class CNCMCodesHandler:
             "timeout": 5.0  // Timeout in seconds
         }
         """
-        if web_request.get_request_type() == 'GET':
+        if web_request.get_request_type() == RequestType.GET:
             # Get all digital I/O states
-            if not self.klippy_apis:
-                return {'result': 'error', 'message': 'Klippy not connected'}
-            
             try:
-                result = await self.klippy_apis.query_objects(
-                    {'cnc_extended_m_codes': None}
-                )
-                status = result.get('cnc_extended_m_codes', {})
+                await self._get_cnc_status('cnc_extended_m_codes')
                 
                 # Extract digital I/O state (would need to add to get_status in Klipper)
-                return {
-                    'result': 'success',
-                    'message': 'Digital I/O status retrieved'
-                }
+                return DIO_STATUS_RESP
             except Exception as e:
                 return {'result': 'error', 'message': str(e)}
         
@@ -466,16 +669,13 @@ class CNCMCodesHandler:
                 timeout = web_request.get_float('timeout', 0.0)
                 analog = web_request.get_boolean('analog', False)
                 
-                if not self.klippy_apis:
-                    return {'result': 'error', 'message': 'Klippy not connected'}
-                
                 try:
                     if analog:
                         command = f"M66 E{pin} L{mode} Q{timeout}"
                     else:
                         command = f"M66 P{pin} L{mode} Q{timeout}"
                     
-                    await self.klippy_apis.run_gcode(command)
+                    await self._submit_gcode(command)
                     
                     return {
                         'result': 'success',
@@ -490,19 +690,11 @@ class CNCMCodesHandler:
                 value = web_request.get_boolean('value')
                 synchronized = web_request.get_boolean('synchronized', False)
                 
-                if not self.klippy_apis:
-                    return {'result': 'error', 'message': 'Klippy not connected'}
-                
                 try:
                     # Choose appropriate M-Code
-                    if synchronized:
-                        # M62 (ON) or M63 (OFF) - synchronized with motion
-                        command = f"M62 P{pin}" if value else f"M63 P{pin}"
-                    else:
-                        # M64 (ON) or M65 (OFF) - immediate
-                        command = f"M64 P{pin}" if value else f"M65 P{pin}"
+                    command = self._DIO_CMDS[(synchronized, value)] % pin
                     
-                    await self.klippy_apis.run_gcode(command)
+                    await self._submit_gcode(command)
                     
                     return {
                         'result': 'success',
@@ -514,6 +706,7 @@ class CNCMCodesHandler:
                 except Exception as e:
                     return {'result': 'error', 'message': str(e)}
     
+    @_require_klippy
     async def _handle_analog_io(self, web_request) -> Dict[str, Any]:
         """
         Control Analog I/O (M67-M68)
@@ -527,22 +720,13 @@ class CNCMCodesHandler:
             "synchronized": false  // false=immediate (M68), true=synchronized (M67)
         }
         """
-        if web_request.get_request_type() == 'GET':
+        if web_request.get_request_type() == RequestType.GET:
             # Get all analog I/O states
-            if not self.klippy_apis:
-                return {'result': 'error', 'message': 'Klippy not connected'}
-            
             try:
-                result = await self.klippy_apis.query_objects(
-                    {'cnc_extended_m_codes': None}
-                )
-                status = result.get('cnc_extended_m_codes', {})
+                await self._get_cnc_status('cnc_extended_m_codes')
                 
                 # Extract analog I/O state (would need to add to get_status in Klipper)
-                return {
-                    'result': 'success',
-                    'message': 'Analog I/O status retrieved'
-                }
+                return AIO_STATUS_RESP
             except Exception as e:
                 return {'result': 'error', 'message': str(e)}
         
@@ -551,9 +735,6 @@ class CNCMCodesHandler:
             value = web_request.get_float('value')
             synchronized = web_request.get_boolean('synchronized', False)
             
-            if not self.klippy_apis:
-                return {'result': 'error', 'message': 'Klippy not connected'}
-            
             try:
                 # Choose appropriate M-Code
                 if synchronized:
@@ -563,7 +744,7 @@ class CNCMCodesHandler:
                     # M68 - immediate
                     command = f"M68 E{pin} Q{value}"
                 
-                await self.klippy_apis.run_gcode(command)
+                await self._submit_gcode(command)
                 
                 return {
                     'result': 'success',
@@ -575,6 +756,7 @@ class CNCMCodesHandler:
             except Exception as e:
                 return {'result': 'error', 'message': str(e)}
     
+    @_require_klippy
     async def _handle_subroutine(self, web_request) -> Dict[str, Any]:
         """
         Execute Subroutine (M98/M99)
@@ -588,23 +770,18 @@ class CNCMCodesHandler:
         """
         action = web_request.get('action', 'call')
         
-        if not self.klippy_apis:
-            return {
-                'result': 'error',
-                'message': 'Klippy not connected'
-            }
-        
         try:
             if action == 'call':
                 # M98 - Call subroutine
                 program = web_request.get_int('program')
                 repeats = web_request.get_int('repeats', 1)
                 
-                command = f"M98 P{program}"
                 if repeats > 1:
-                    command += f" L{repeats}"
+                    command = f"M98 P{program} L{repeats}"
+                else:
+                    command = f"M98 P{program}"
                 
-                await self.klippy_apis.run_gcode(command)
+                await self._submit_gcode(command)
                 
                 return {
                     'result': 'success',
@@ -617,14 +794,9 @@ class CNCMCodesHandler:
             
             elif action == 'return':
                 # M99 - Return from subroutine
-                await self.klippy_apis.run_gcode("M99")
+                await self._submit_gcode("M99")
                 
-                return {
-                    'result': 'success',
-                    'command': 'M99',
-                    'action': 'return',
-                    'message': 'Returned from subroutine'
-                }
+                return SUBROUTINE_RETURN_RESP
             
             else:
                 return {
@@ -632,12 +804,29 @@ class CNCMCodesHandler:
                     'message': f'Invalid action: {action}'
                 }
         
+        except self.server.error as e:
+            logging.debug(f"Subroutine operation rejected: {e}")
+            return {
+                'result': 'error',
+                'message': str(e)
+            }
         except Exception as e:
-            logging.exception(f"Subroutine operation failed: {e}")
+            logging.exception("Subroutine operation failed")
             return {
                 'result': 'error',
                 'message': str(e)
             }
 
+    async def close(self) -> None:
+        if self._batch_task is not None and not self._batch_task.done():
+            self._batch_task.cancel()
+            try:
+                await self._batch_task
+            except asyncio.CancelledError:
+                pass
+        while not self._gcode_queue.empty():
+            _, fut, _ = self._gcode_queue.get_nowait()
+            fut.cancel()
+
 def load_component(config: ConfigHelper) -> CNCMCodesHandler:
     return CNCMCodesHandler(config)
@@ -6,11 +6,11 @@
 
 from __future__ import annotations
 import logging
+import asyncio
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from ..confighelper import ConfigHelper
     from .klippy_apis import KlippyAPI
-    from .klippy_connection import KlippyConnection
 
 class M2RestartHandler:
     """
@@ -30,6 +30,10 @@ class M2RestartHandler:
     
     def __init__(self, config: ConfigHelper) -> None:
         self.server = config.get_server()
+        self.eventloop = self.server.get_event_loop()
+        self.klippy_apis: KlippyAPI | None = None
+        self._last_state: str | None = None
+        self._reset_task: asyncio.Task | None = None
         
         # Register REST API endpoint for manual reset
         self.server.register_endpoint(
@@ -42,56 +46,67 @@ class M2RestartHandler:
         self.server.register_event_handler(
             "server:klippy_ready", self._handle_klippy_ready
         )
+        # Subscribe to print_stats to detect when M2 RESTART is executed
+        self.server.register_event_handler(
+            "server:status_update", self._check_restart_execution
+        )
         
         logging.info("M2 RESTART Handler initialized - Endpoint: /server/cnc/restart")
     
     async def _handle_restart_endpoint(self, web_request) -> dict:
         """Handle explicit restart requests via REST API"""
-        try:
-            # Try to reset file position if Klipper is available
+        # Try to reset file position if Klipper is available
+        klippy_apis = self.klippy_apis
+        if klippy_apis is None:
+            message = "M2 RESTART acknowledged (Klipper not connected)"
+        else:
             try:
-                klippy_apis: KlippyAPI = self.server.lookup_component('klippy_apis')
                 await klippy_apis.run_gcode("SDCARD_RESET_FILE")
                 message = "M2 RESTART executed - file position reset for repeat"
             except Exception:
                 # Klipper not available - just acknowledge
                 message = "M2 RESTART acknowledged (Klipper not connected)"
-            
-            logging.info(message)
-            return {"result": "ok", "message": message}
-        except Exception as e:
-            logging.error(f"M2 RESTART Handler error: {e}")
-            return {"error": str(e)}
+        
+        logging.info(message)
+        return {"result": "ok", "message": message}
     
     async def _handle_klippy_ready(self) -> None:
         """Hook into G-Code processing when Klippy is ready"""
-        try:
-            klippy: KlippyConnection = self.server.lookup_component('klippy_connection')
-            # Subscribe to print_stats to detect when M2 RESTART is executed
-            self.server.register_event_handler(
-                "server:status_update", self._check_restart_execution
-            )
-            logging.info("M2 RESTART Handler ready - monitoring for virtual_sdcard:complete event")
-        except Exception as e:
-            logging.info(f"M2 RESTART Handler: Could not hook into Klippy: {e}")
+        self.klippy_apis = self.server.lookup_component('klippy_apis')
+        logging.info("M2 RESTART Handler ready - monitoring for virtual_sdcard:complete event")
     
-    async def _check_restart_execution(self, status_update: dict) -> None:
+    def _check_restart_execution(self, status_update: dict) -> None:
         """
-        Check if print has ended (state = complete)
+        Check if print has ended (state transitions to complete)
         This indicates M2 RESTART was executed
         (triggered by printer.send_event("virtual_sdcard:complete") in cnc_program_control.py)
         """
-        print_stats = status_update.get('print_stats', {})
-        if print_stats.get('state') == 'complete':
-            # Job completed via M2 RESTART
-            # Reset file position for program repeat
-            try:
-                klippy_apis: KlippyAPI = self.server.lookup_component('klippy_apis')
-                await klippy_apis.run_gcode("SDCARD_RESET_FILE")
-                logging.info("M2 RESTART detected - File position reset for repeat (CNC mode)")
-            except Exception as e:
-                # Not critical - file might not be from SD
-                logging.debug(f"Could not reset file position: {e}")
+        print_stats = status_update.get('print_stats')
+        if print_stats is None:
+            return
+        new_state = print_stats.get('state')
+        if new_state is None or new_state == self._last_state:
+            return
+        self._last_state = new_state
+        if new_state != 'complete':
+            return
+        # Job completed via M2 RESTART.  Reset the file position for
+        # program repeat in the background so other status update
+        # handlers are not delayed by the request to Klippy.
+        if self._reset_task is None or self._reset_task.done():
+            self._reset_task = self.eventloop.create_task(
+                self._reset_file_position()
+            )
+    
+    async def _reset_file_position(self) -> None:
+        if self.klippy_apis is None:
+            return
+        try:
+            await self.klippy_apis.run_gcode("SDCARD_RESET_FILE")
+            logging.info("M2 RESTART detected - File position reset for repeat (CNC mode)")
+        except Exception as e:
+            # Not critical - file might not be from SD
+            logging.debug(f"Could not reset file position: {e}")
 
 def load_component(config: ConfigHelper) -> M2RestartHandler:
     return M2RestartHandler(config)
@@ -0,0 +1,167 @@
+from __future__ import annotations
+import pytest
+import pytest_asyncio
+import asyncio
+from moonraker.common import RequestType, WebRequest
+from moonraker.utils import ServerError
+from moonraker.components.cnc_extended_api import CNCMCodesHandler
+
+from typing import AsyncIterator, Any, Dict, List, Set
+
+class MockEventLoop:
+    def __init__(self) -> None:
+        self.aioloop = asyncio.get_running_loop()
+
+    def create_task(self, coro):
+        return self.aioloop.create_task(coro)
+
+    def create_future(self) -> asyncio.Future:
+        return self.aioloop.create_future()
+
+    def get_loop_time(self) -> float:
+        return self.aioloop.time()
+
+class MockKlippyAPI:
+    def __init__(self) -> None:
+        self.scripts: List[str] = []
+        self.failing: Set[str] = set()
+        self.status: Dict[str, Any] = {}
+        self.query_delay: float = 0.
+
+    async def run_gcode(self, script: str) -> str:
+        self.scripts.append(script)
+        await asyncio.sleep(0)
+        for line in script.split("\n"):
+            if line in self.failing:
+                raise ServerError(f"Error running {line}")
+        return "ok"
+
+    async def query_objects(self, objects: Dict[str, Any]) -> Dict[str, Any]:
+        result = {obj: dict(self.status) for obj in objects}
+        await asyncio.sleep(self.query_delay)
+        return result
+
+class MockServer:
+    error = ServerError
+
+    def __init__(self) -> None:
+        self.eventloop = MockEventLoop()
+        self.klippy_apis = MockKlippyAPI()
+
+    def get_event_loop(self) -> MockEventLoop:
+        return self.eventloop
+
+    def register_endpoint(self, *args, **kwargs) -> None:
+        pass
+
+    def register_event_handler(self, *args) -> None:
+        pass
+
+    def lookup_component(self, name: str) -> MockKlippyAPI:
+        assert name == "klippy_apis"
+        return self.klippy_apis
+
+class MockConfig:
+    def __init__(self, server: MockServer) -> None:
+        self.server = server
+
+    def get_server(self) -> MockServer:
+        return self.server
+
+@pytest_asyncio.fixture()
+async def handler() -> AsyncIterator[CNCMCodesHandler]:
+    cnc = CNCMCodesHandler(MockConfig(MockServer()))  # type: ignore
+    await cnc._handle_klippy_ready()
+    yield cnc
+    await cnc.close()
+
+@pytest.mark.asyncio
+class TestGcodeBatcher:
+    async def test_batch_requests(self, handler: CNCMCodesHandler):
+        apis: MockKlippyAPI = handler.klippy_apis  # type: ignore
+        ret = await asyncio.gather(
+            handler._submit_gcode("M8"),
+            handler._submit_gcode("S1000\nM3")
+        )
+        assert ret == ["ok", "ok"]
+        assert apis.scripts == ["M8\nS1000\nM3"]
+
+    async def test_failed_batch_resent(self, handler: CNCMCodesHandler):
+        apis: MockKlippyAPI = handler.klippy_apis  # type: ignore
+        apis.failing.add("M64 P3")
+        ret = await asyncio.gather(
+            handler._submit_gcode("M64 P3"),
+            handler._submit_gcode("M5"),
+            return_exceptions=True
+        )
+        assert isinstance(ret[0], ServerError)
+        assert ret[1] == "ok"
+        assert apis.scripts == ["M64 P3\nM5", "M64 P3", "M5"]
+
+    async def test_blocking_not_batched(self, handler: CNCMCodesHandler):
+        apis: MockKlippyAPI = handler.klippy_apis  # type: ignore
+        apis.failing.add("M66 P1 L3 Q1.0")
+        ret = await asyncio.gather(
+            handler._submit_gcode("M66 P1 L3 Q1.0"),
+            handler._submit_gcode("M5"),
+            return_exceptions=True
+        )
+        assert isinstance(ret[0], ServerError)
+        assert ret[1] == "ok"
+        assert apis.scripts == ["M66 P1 L3 Q1.0", "M5"]
+
+    async def test_batch_order(self, handler: CNCMCodesHandler):
+        apis: MockKlippyAPI = handler.klippy_apis  # type: ignore
+        await asyncio.gather(
+            handler._submit_gcode("M7"),
+            handler._submit_gcode("M0\nT2"),
+            handler._submit_gcode("M9"),
+            handler._submit_gcode("M5")
+        )
+        assert apis.scripts == ["M7", "M0\nT2", "M9\nM5"]
+
+    async def test_stale_status_not_cached(self, handler: CNCMCodesHandler):
+        apis: MockKlippyAPI = handler.klippy_apis  # type: ignore
+        apis.status = {'spindle_running': True}
+        apis.query_delay = .05
+        query = asyncio.create_task(handler._get_cnc_status())
+        await asyncio.sleep(0)
+        await handler._submit_gcode("M5")
+        apis.status = {'spindle_running': False}
+        assert (await query)['spindle_running'] is True
+        status = await handler._get_cnc_status()
+        assert status['spindle_running'] is False
+
+    async def test_close_during_delay(self, handler: CNCMCodesHandler):
+        apis: MockKlippyAPI = handler.klippy_apis  # type: ignore
+        fut = handler._submit_gcode("M8")
+        await asyncio.sleep(.001)
+        await handler.close()
+        assert fut.cancelled()
+        assert apis.scripts == []
+
+@pytest.mark.asyncio
+class TestHandlers:
+    async def test_manual_tool_change(self, handler: CNCMCodesHandler):
+        apis: MockKlippyAPI = handler.klippy_apis  # type: ignore
+        args = {'tool': 3, 'manual': True}
+        req = WebRequest("/server/cnc/tool_change", args, RequestType.POST)
+        ret = await handler._handle_tool_change(req)
+        assert ret['result'] == "success"
+        assert apis.scripts == ["M0\nT3\nM117 Insert Tool T3 and resume"]
+
+    async def test_coolant_mist_only(self, handler: CNCMCodesHandler):
+        apis: MockKlippyAPI = handler.klippy_apis  # type: ignore
+        args = {'mist': True, 'flood': False}
+        req = WebRequest("/server/cnc/coolant", args, RequestType.POST)
+        ret = await handler._handle_coolant(req)
+        assert ret['result'] == "success"
+        assert apis.scripts == ["M9\nM7"]
+
+    async def test_coolant_no_op(self, handler: CNCMCodesHandler):
+        apis: MockKlippyAPI = handler.klippy_apis  # type: ignore
+        req = WebRequest("/server/cnc/coolant", {}, RequestType.POST)
+        ret = await handler._handle_coolant(req)
+        assert ret['result'] == "success"
+        assert ret['message'] == "no-op"
+        assert apis.scripts == []
@@ -0,0 +1,79 @@
+from __future__ import annotations
+import pytest
+import asyncio
+from moonraker.components.m2_restart_handler import M2RestartHandler
+
+from typing import Any, Callable, Dict, List
+
+class MockEventLoop:
+    def __init__(self) -> None:
+        self.aioloop = asyncio.get_running_loop()
+        self.task_count = 0
+
+    def create_task(self, coro) -> asyncio.Task:
+        self.task_count += 1
+        return self.aioloop.create_task(coro)
+
+class MockKlippyAPI:
+    def __init__(self) -> None:
+        self.scripts: List[str] = []
+
+    async def run_gcode(self, script: str) -> str:
+        self.scripts.append(script)
+        await asyncio.sleep(0)
+        return "ok"
+
+class MockServer:
+    def __init__(self) -> None:
+        self.eventloop = MockEventLoop()
+        self.klippy_apis = MockKlippyAPI()
+        self.events: Dict[str, List[Callable]] = {}
+
+    def get_event_loop(self) -> MockEventLoop:
+        return self.eventloop
+
+    def register_endpoint(self, *args, **kwargs) -> None:
+        pass
+
+    def register_event_handler(self, event: str, callback: Callable) -> None:
+        self.events.setdefault(event, []).append(callback)
+
+    def lookup_component(self, name: str) -> MockKlippyAPI:
+        assert name == "klippy_apis"
+        return self.klippy_apis
+
+class MockConfig:
+    def __init__(self, server: MockServer) -> None:
+        self.server = server
+
+    def get_server(self) -> MockServer:
+        return self.server
+
+async def send_update(server: MockServer, update: Dict[str, Any]) -> None:
+    for callback in server.events["server:status_update"]:
+        callback(update)
+    # Let any scheduled reset run to completion
+    await asyncio.sleep(.01)
+
+@pytest.mark.asyncio
+async def test_reset_on_complete_transition():
+    server = MockServer()
+    m2 = M2RestartHandler(MockConfig(server))  # type: ignore
+    await m2._handle_klippy_ready()
+    await m2._handle_klippy_ready()
+    assert len(server.events["server:status_update"]) == 1
+    for state in ("printing", "complete", "complete", "standby", "complete"):
+        await send_update(server, {'print_stats': {'state': state}})
+    assert server.eventloop.task_count == 2
+    assert server.klippy_apis.scripts == ["SDCARD_RESET_FILE"] * 2
+
+@pytest.mark.asyncio
+async def test_update_without_print_stats():
+    server = MockServer()
+    m2 = M2RestartHandler(MockConfig(server))  # type: ignore
+    await m2._handle_klippy_ready()
+    await send_update(server, {'print_stats': {'state': "complete"}})
+    await send_update(server, {'toolhead': {'position': [0, 0, 0, 0]}})
+    await send_update(server, {'print_stats': {'state': "complete"}})
+    assert server.eventloop.task_count == 1
+    assert server.klippy_apis.scripts == ["SDCARD_RESET_FILE"]